@@ -1,4 +1,5 @@
-from typing import List
+from typing import List, Dict, Tuple
+from collections import OrderedDict
 from copy import copy
 from inspect import isclass
 
@@ -8,7 +9,9 @@ from torch.nn import Module, Sequential, ModuleList, ModuleDict
 
 from .module import CodegenModule, Index, Instruction
 from .tracer.trace import Trace, TraceElem, FnType
-from .utils import module_class_name, flatten
+from .utils import module_class_name
+
+_NOT_FOUND = object()
 
 
 class ModuleGenerator(object):
@@ -19,66 +22,119 @@ class ModuleGenerator(object):
     def __init__(
             self,
             gen_module_allowlist=tuple(default_gen_module_allowlist),
-            gen_module_blocklist=tuple(default_gen_module_blocklist)):
-        self.gen_module_allowlist = list(gen_module_allowlist)
-        self.gen_module_blocklist = list(gen_module_blocklist)
-        self._generated_allowlist_modules = []
+            gen_module_blocklist=tuple(default_gen_module_blocklist),
+            gen_cache_size: int = 1):
+        # trace fingerprint -> (trace, generated model), the trace keeps the fingerprinted ids alive
+        # at most gen_cache_size traces are retained, together with all the values they reference
+        self.gen_cache_size = gen_cache_size
+        self._gen_cache: Dict[Tuple, Tuple[Trace, CodegenModule]] = OrderedDict()
+        self.gen_module_allowlist = gen_module_allowlist
+        self.gen_module_blocklist = gen_module_blocklist
+        # (id(module), ids of module inputs, id(module output)) -> (module, inputs, output)
+        # the values keep the referenced objects alive, so that ids can't be recycled
+        # reset at every generation
+        self._generated_allowlist_modules: Dict[Tuple[int, Tuple[int, ...], int], Tuple] = {}
         self._module_name_id_dict = {}
+        self._prefix_cache: Dict[Tuple[str, ...], Module] = {}
+
+    @property
+    def gen_module_allowlist(self):
+        return self._gen_module_allowlist
+
+    @gen_module_allowlist.setter
+    def gen_module_allowlist(self, gen_module_allowlist):
+        # stored as a tuple so that it can't be mutated behind the back of the cache
+        self._gen_module_allowlist = tuple(gen_module_allowlist)
+        self._allow_str_prefixes, self._allow_classes = self._split_gen_list(
+            self._gen_module_allowlist)
+        self._allow_cache: Dict[type, bool] = {}
+        self.clear_cache()
+
+    @property
+    def gen_module_blocklist(self):
+        return self._gen_module_blocklist
+
+    @gen_module_blocklist.setter
+    def gen_module_blocklist(self, gen_module_blocklist):
+        self._gen_module_blocklist = tuple(gen_module_blocklist)
+        self._block_str_prefixes, self._block_classes = self._split_gen_list(
+            self._gen_module_blocklist)
+        self._block_cache: Dict[type, bool] = {}
+        self.clear_cache()
+
+    @staticmethod
+    def _split_gen_list(gen_list):
+        str_prefixes = tuple(gm for gm in gen_list if isinstance(gm, str))
+        classes = tuple(gm for gm in gen_list if isclass(gm))
+        return str_prefixes, classes
 
     def _parent_in_gen_allowlist(self, trace_elem):
         # find parent that has to be preserved as-is, if any
-        output = None
-        # context is all parent modules, from the inner most to the outer most
-        context = reversed(trace_elem.module_context_list[:-1])
-        for c in context:
-            for gma in self.gen_module_allowlist:
-                if isinstance(gma, str) and module_class_name(c).startswith(gma):
-                    if not self._is_module_in_gen_blocklist(c):
-                        output = c
-                elif isclass(gma) and isinstance(c, gma):
-                    if not self._is_module_in_gen_blocklist(c):
-                        output = c
-        return output
+        # context is all parent modules, from the outer most to the inner most
+        # the outer most parent in the allowlist (and not in the blocklist) is the one preserved,
+        # so the first match going from the outside in is returned
+        for c in trace_elem.module_context_list[:-1]:
+            if self._is_module_in_gen_allowlist(c) and not self._is_module_in_gen_blocklist(c):
+                return c
+        return None
 
-    def _is_module_in_gen_list(self, module, gen_list):
-        output = False
-        for gm in gen_list:
-            output |= isinstance(gm, str) and module_class_name(module).startswith(gm)
-            output |= isclass(gm) and isinstance(module, gm)
+    def _is_module_in_gen_list(self, module, str_prefixes, classes, cache):
+        # classification depends only on the type of the module, so it's cached by type
+        module_type = type(module)
+        cached = cache.get(module_type)
+        if cached is not None:
+            return cached
+        # both checks take a tuple, i.e. a single call across all classes and prefixes
+        output = isinstance(module, classes) or module_class_name(module).startswith(str_prefixes)
+        cache[module_type] = output
         return output
 
     def _is_module_in_gen_blocklist(self, module):
-        return self._is_module_in_gen_list(module, self.gen_module_blocklist)
+        return self._is_module_in_gen_list(
+            module, self._block_str_prefixes, self._block_classes, self._block_cache)
 
     def _is_module_in_gen_allowlist(self, module):
-        return self._is_module_in_gen_list(module, self.gen_module_allowlist)
+        return self._is_module_in_gen_list(
+            module, self._allow_str_prefixes, self._allow_classes, self._allow_cache)
+
+    def _gen_key(self, module, trace_elem):
+        input_ids = tuple(id(i) for i in trace_elem.module_input_list)
+        return id(module), input_ids, id(trace_elem.module_output)
 
-    def _is_module_already_gen(self, module, trace_elem):
-        is_already_gen = False
+    def _is_module_already_gen(self, gen_key):
         # check that the module itself hasn't been generated yet
         # input and output have to be the same
         # otherwise it's a different invokation of the same module
-        for m, i_list, o in self._generated_allowlist_modules:
-            same_module = m is module
-            same_input = all([i is mi for i, mi in zip(i_list, trace_elem.module_input_list)])
-            same_output = o is trace_elem.module_output
-            is_already_gen |= same_module and same_input and same_output
-        # check that none of the parents has been already preserved as-is
-        for c in trace_elem.module_context_list:  # TODO same input and output across parents
-            for m in self._generated_allowlist_modules:
-                is_already_gen |= c is m
-        return is_already_gen
+        return gen_key in self._generated_allowlist_modules
 
     def _add_module(self, module: Module, module_name, prefix_list, model: Module):
-        supermodule = model
-        for prefix in prefix_list:
-            submodule_names, submodules = zip(*list(supermodule.named_modules()))
-            if prefix in submodule_names:
-                supermodule = supermodule._modules[prefix]
-            else:
-                submodule = Module()
-                supermodule.add_module(prefix, submodule)
-                supermodule = submodule
+        # the cache maps a prefix of model to the supermodule found or created for it
+        if self._prefix_cache.get(()) is not model:
+            self._prefix_cache = {(): model}
+        prefix_key = tuple(prefix_list)
+        supermodule = self._prefix_cache.get(prefix_key)
+        if supermodule is None:
+            # walk only from the longest prefix already resolved
+            i = len(prefix_key) - 1
+            while prefix_key[:i] not in self._prefix_cache:
+                i -= 1
+            supermodule = self._prefix_cache[prefix_key[:i]]
+            for j in range(i, len(prefix_key)):
+                prefix = prefix_key[j]
+                # a prefix can only collide with a direct child, no need to walk the subtree
+                if prefix in supermodule._modules:
+                    supermodule = supermodule._modules[prefix]
+                else:
+                    submodule = Module()
+                    supermodule.add_module(prefix, submodule)
+                    supermodule = submodule
+                self._prefix_cache[prefix_key[:j + 1]] = supermodule
+        module_key = prefix_key + (module_name,)
+        if module_key in self._prefix_cache:
+            # the module replaces a cached supermodule, drop it together with what's below it
+            stale_keys = [k for k in self._prefix_cache if k[:len(module_key)] == module_key]
+            for k in stale_keys:
+                del self._prefix_cache[k]
         supermodule.add_module(module_name, module)
 
     def _module_instruction(
@@ -86,116 +142,193 @@ class ModuleGenerator(object):
         module_name = trace_elem.prefix_list[-1]
         prefix_list = trace_elem.prefix_list[:-1]  # exclude module name
         self._add_module(module, module_name, prefix_list, output_model)
-        iil = [trace.index_from_val(i) for i in trace_elem.module_input_list]
-        module_output_index = trace.index_from_val(trace_elem.module_output)
+        # indexes of the module input and output are computed once at tracing time
+        iil = trace_elem.module_input_index_list
+        module_output_index = trace_elem.module_output_index
         inst = Instruction(module_output_index, module, FnType.MODULE, iil, {}, trace_elem.prefix)
         return inst
 
-    def _module_fn_instruction(self, trace_elem: TraceElem, output_model):
-        module = trace_elem.fn
-        module_name = trace_elem.module_fn_name
-        self._add_module(module, module_name, trace_elem.prefix_list, output_model)
-        return self._torch_fn_instruction(trace_elem)
-
-    def _torch_fn_instruction(self, trace_elem: TraceElem):
-        fn_args = trace_elem.fn_args_index
-        fn_kwargs = trace_elem.fn_kwargs_index
-        fn = trace_elem.fn
+    def _fn_instruction(self, trace_elem: TraceElem, trace: Trace, gen_model: Module):
         fn_type = trace_elem.fn_type
-        output_index = trace_elem.fn_out_index
-        return Instruction(output_index, fn, fn_type, fn_args, fn_kwargs, trace_elem.prefix)
+        if fn_type is FnType.MODULE:
+            # the module is registered, then called like any other traced fn
+            module_name = trace_elem.module_fn_name
+            self._add_module(trace_elem.fn, module_name, trace_elem.prefix_list, gen_model)
+        elif fn_type is FnType.SCRIPTMODULE:
+            return self._module_instruction(trace_elem.fn, trace_elem, trace, gen_model)
+        elif not (
+                fn_type is FnType.FUNCTION or fn_type is FnType.METHOD
+                or fn_type is FnType.ATTRIBUTE):
+            raise RuntimeError(f"Unexpected fn_type {fn_type}")
+        # torch functions, tensor methods, tensor attributes and module fns map to the fn as-is
+        return Instruction(
+            trace_elem.fn_out_index,
+            trace_elem.fn,
+            fn_type,
+            trace_elem.fn_args_index,
+            trace_elem.fn_kwargs_index,
+            trace_elem.prefix)
 
-    def _tensor_fn_instruction(self, trace_elem: TraceElem, trace: Trace):
-        fn = trace_elem.fn
-        fn_type = trace_elem.fn_type
-        fn_args = trace_elem.fn_args_index
-        fn_kwargs = trace_elem.fn_kwargs_index
-        output_index = trace_elem.fn_out_index
-        return Instruction(output_index, fn, fn_type, fn_args, fn_kwargs, trace_elem.prefix)
+    def _any_module_in_gen_allowlist(self, trace: Trace):
+        if not trace.trace_elem_list:
+            return False
+        # every context starts from the traced model, so its submodules cover all the contexts
+        model = trace.trace_elem_list[0].module_context_list[0]
+        return any(
+            self._is_module_in_gen_allowlist(m) and not self._is_module_in_gen_blocklist(m)
+            for m in model.modules())
 
     def _gen_schedule(self, trace: Trace, gen_model: Module):
-        schedule = []
+        if not self._any_module_in_gen_allowlist(trace):
+            # nothing is preserved as-is, so there's no need to check the allowlist per trace elem
+            return [self._fn_instruction(te, trace, gen_model) for te in trace.trace_elem_list]
+        # bind once what is looked up at every iteration
+        parent_in_gen_allowlist = self._parent_in_gen_allowlist
+        is_module_in_gen_allowlist = self._is_module_in_gen_allowlist
+        is_module_in_gen_blocklist = self._is_module_in_gen_blocklist
+        is_module_already_gen = self._is_module_already_gen
+        generated_allowlist_modules = self._generated_allowlist_modules
+        module_instruction = self._module_instruction
+        fn_instruction = self._fn_instruction
+        gen_key_fn = self._gen_key
+        # at most one instruction per trace elem, the unused tail is dropped at the end
+        schedule = [None] * len(trace.trace_elem_list)
+        schedule_len = 0
         for trace_elem in trace.trace_elem_list:
             module = trace_elem.module_context_list[-1]
             # if a parent is supposed to be preserved as is
-            parent_in_allowlist = self._parent_in_gen_allowlist(trace_elem)
+            parent_in_allowlist = parent_in_gen_allowlist(trace_elem)
             # If the module wrapping this fn is supposed to be preserved as-is
-            in_allowlist = self._is_module_in_gen_allowlist(module)
-            in_allowlist &= not self._is_module_in_gen_blocklist(module)
-            # if either the wrapping module or parents have been already preserved as-is
-            m_already_gen = self._is_module_already_gen(module, trace_elem)
-            inst = None
+            in_allowlist = is_module_in_gen_allowlist(module)
+            in_allowlist &= not is_module_in_gen_blocklist(module)
+            # if the wrapping module has been already preserved as-is
+            gen_key = gen_key_fn(module, trace_elem)
+            m_already_gen = is_module_already_gen(gen_key)
             if parent_in_allowlist is not None and not m_already_gen:
                 ctx = (module, trace_elem.module_input_list, trace_elem.module_output)
-                self._generated_allowlist_modules.append(ctx)
-                inst = self._module_instruction(parent_in_allowlist, trace_elem, trace, gen_model)
+                generated_allowlist_modules[gen_key] = ctx
+                inst = module_instruction(parent_in_allowlist, trace_elem, trace, gen_model)
             elif in_allowlist and not m_already_gen:
                 ctx = (module, trace_elem.module_input_list, trace_elem.module_output)
-                self._generated_allowlist_modules.append(ctx)
-                inst = self._module_instruction(module, trace_elem, trace, gen_model)
+                generated_allowlist_modules[gen_key] = ctx
+                inst = module_instruction(module, trace_elem, trace, gen_model)
             elif in_allowlist and m_already_gen:
                 continue
             else:
-                if trace_elem.fn_type == FnType.MODULE:
-                    inst = self._module_fn_instruction(trace_elem, gen_model)
-                elif trace_elem.fn_type == FnType.FUNCTION:
-                    inst = self._torch_fn_instruction(trace_elem)
-                elif trace_elem.fn_type == FnType.METHOD:
-                    inst = self._tensor_fn_instruction(trace_elem, trace)
-                elif trace_elem.fn_type == FnType.ATTRIBUTE:
-                    inst = self._tensor_fn_instruction(trace_elem, trace)
-                elif trace_elem.fn_type == FnType.SCRIPTMODULE:
-                    inst = self._module_instruction(trace_elem.fn, trace_elem, trace, gen_model)
-                assert inst is not None
-            schedule.append(inst)
+                inst = fn_instruction(trace_elem, trace, gen_model)
+            schedule[schedule_len] = inst
+            schedule_len += 1
+        del schedule[schedule_len:]
         return schedule
 
-    # constants are all inputs not computed as outputs, excluding the model input
-    def _gen_constants_parameters(self, schedule: List[Instruction], trace: Trace):
-        output_index_list = [inst.output_index for inst in schedule]
-        input_index_list = flatten([i for inst in schedule for i in inst.input_args_list])
-        input_index_list += flatten([i for inst in schedule for n, i in inst.input_kwargs_dict.items()])
-        # remove topmost inputs from constants
-        const_index_list = [i for i in input_index_list if i not in trace.model_input_index_list]
-        # remove values generated as output from constants
-        const_index_list = [i for i in const_index_list if i not in output_index_list]
-        # filter out parameters
-        consts = {c: trace.index_map[c] for c in const_index_list if not isinstance(c, Parameter)}
-        params = {c: trace.index_map[c] for c in const_index_list if isinstance(c, Parameter)}
-        # only scalar tensors are accepted as constants, otherwise throw an error
-        consts = {k: v.item() if isinstance(v, Tensor) else v for k, v in consts.items()}
-        if None in consts.keys():
-            raise RuntimeError("Something went wrong")
-        return consts, params
-
-    def _solve_consts_params(self, arg, consts, params):
-        if isinstance(arg, list):
-            return [self._solve_consts_params(a, consts, params) for a in arg]
-        elif isinstance(arg, tuple):
-            return tuple(self._solve_consts_params(a, consts, params) for a in arg)
-        elif isinstance(arg, dict):
-            return {k: self._solve_consts_params(v, consts, params) for k, v in arg.items()}
-        elif isinstance(arg, Index):
-            if arg in consts:
-                return consts[arg]
-            elif arg in params:
-                return params[arg]
+    def _solve_index(self, arg, consts, non_const_index_set, trace):
+        value = consts.get(arg, _NOT_FOUND)
+        if value is _NOT_FOUND:
+            if arg in non_const_index_set:
+                return arg
+            value = trace.index_map[arg]
+            # parameters are passed as-is to the fn consuming them
+            # otherwise only scalar tensors are accepted as constants, else throw an error
+            if isinstance(value, Tensor) and not isinstance(value, Parameter):
+                value = value.item()
+            consts[arg] = value
+        return value
+
+    def _solve_list(self, arg, consts, non_const_index_set, trace):
+        return [self._solve_consts(a, consts, non_const_index_set, trace) for a in arg]
+
+    def _solve_tuple(self, arg, consts, non_const_index_set, trace):
+        return tuple(self._solve_consts(a, consts, non_const_index_set, trace) for a in arg)
+
+    def _solve_dict(self, arg, consts, non_const_index_set, trace):
+        return {
+            k: self._solve_consts(v, consts, non_const_index_set, trace) for k, v in arg.items()}
+
+    _solve_handler_dict = {
+        list: _solve_list,
+        tuple: _solve_tuple,
+        dict: _solve_dict,
+        Index: _solve_index}
+
+    def _solve_consts(self, arg, consts, non_const_index_set, trace):
+        arg_type = type(arg)
+        # common case first
+        if arg_type is Index:
+            return self._solve_index(arg, consts, non_const_index_set, trace)
+        handler = self._solve_handler_dict.get(arg_type)
+        if handler is None:
+            # fall back to isinstance for subclasses
+            for handled_type, h in self._solve_handler_dict.items():
+                if isinstance(arg, handled_type):
+                    handler = h
+                    break
             else:
                 return arg
-        else:
-            return arg
+        return handler(self, arg, consts, non_const_index_set, trace)
 
-    def _apply_consts_params(self, schedule, consts, params):
+    # constants are all inputs not computed as outputs, excluding the model input
+    # they are replaced by their value in a single pass over the inputs of the schedule
+    def _resolve_constants(self, schedule: List[Instruction], trace: Trace):
+        non_const_index_set = set(inst.output_index for inst in schedule)
+        non_const_index_set.update(trace.model_input_index_list)
+        consts = {}  # values resolved so far, shared across instructions
         for inst in schedule:
-            inst.input_args_list = self._solve_consts_params(inst.input_args_list, consts, params)
-            inst.input_kwargs_dict = self._solve_consts_params(inst.input_kwargs_dict, consts, params)
+            inst.input_args_list = self._solve_consts(
+                inst.input_args_list, consts, non_const_index_set, trace)
+            inst.input_kwargs_dict = self._solve_consts(
+                inst.input_kwargs_dict, consts, non_const_index_set, trace)
+
+    def clear_cache(self):
+        # needed when a trace is modified in place after being passed to gen_model
+        self._gen_cache = OrderedDict()
+
+    def _trace_fingerprint(self, trace: Trace):
+        return tuple(
+            (id(te.fn), te.fn_type, tuple(map(id, te.module_input_list)), id(te.module_output))
+            for te in trace.trace_elem_list)
+
+    def _clone_hierarchy(self, source: Module, clone: Module):
+        for name, submodule in source._modules.items():
+            # plain Module containers are created by _add_module, everything else is shared
+            if type(submodule) is Module:
+                submodule = self._clone_hierarchy(submodule, Module())
+            clone.add_module(name, submodule)
+        return clone
+
+    def _clone_gen_model(self, gen_model: CodegenModule):
+        # rewriters modify instructions, their inputs and the module hierarchy in place,
+        # so those are copied while the generated modules themselves are shared
+        clone = self._clone_hierarchy(gen_model, CodegenModule())
+        clone.schedule = [
+            Instruction(
+                inst.output_index,
+                inst.fn,
+                inst.fn_type,
+                copy(inst.input_args_list),
+                copy(inst.input_kwargs_dict),
+                inst.prefix) for inst in gen_model.schedule]
+        clone.input_index_list = copy(gen_model.input_index_list)
+        clone.output_index_list = copy(gen_model.output_index_list)
+        return clone
 
     def gen_model(self, trace: Trace):
+        fingerprint = None
+        if self.gen_cache_size > 0:
+            fingerprint = self._trace_fingerprint(trace)
+            cached = self._gen_cache.get(fingerprint)
+            if cached is not None:
+                self._gen_cache.move_to_end(fingerprint)
+                return self._clone_gen_model(cached[1])
+        self._generated_allowlist_modules = {}
         output_model = CodegenModule()
         schedule = self._gen_schedule(trace, output_model)
-        consts, params = self._gen_constants_parameters(schedule, trace)
-        self._apply_consts_params(schedule, consts, params)
+        self._resolve_constants(schedule, trace)
         output_model.schedule = schedule
         output_model.input_index_list = trace.model_input_index_list
         output_model.output_index_list = trace.model_output_index_list
-        return output_model
\ No newline at end of file
+        if fingerprint is not None:
+            # callers rewrite the returned model in place, so a pristine clone is cached instead
+            self._gen_cache[fingerprint] = (trace, self._clone_gen_model(output_model))
+            while len(self._gen_cache) > self.gen_cache_size:
+                self._gen_cache.popitem(last=False)  # evict the least recently used trace
+        return output_model
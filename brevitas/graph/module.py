@@ -2,10 +2,18 @@ from typing import List, Union, Callable, Dict, Any
 from dataclasses import dataclass
 from brevitas.utils.python_utils import AutoName
 from enum import auto
+from itertools import chain
+import operator
 
+from torch import Tensor
 from torch.nn import Module, Parameter
 
-from .utils import flatten
+from .utils import flatten, _inner_flatten
+
+try:
+    from torch import fx
+except ImportError:  # torch.fx is available from torch 1.8
+    fx = None
 
 
 class FnType(AutoName):
@@ -38,14 +46,32 @@ def _replace_module(model, old_module, new_module):
 
 @dataclass(eq=True, frozen=True)
 class Index:
+    __slots__ = ('id',)
     id: int
 
+    def __hash__(self):
+        return self.id
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.id == other.id
+
+    # frozen and slotted, so copy and pickle can't restore the state through setattr
+    def __getstate__(self):
+        return self.id
+
+    def __setstate__(self, state):
+        object.__setattr__(self, 'id', state)
+
     def __str__(self):
         return str(f"_{self.id}")
 
 
 @dataclass
 class Instruction(object):
+    __slots__ = (
+        'output_index', 'fn', 'fn_type', 'input_args_list', 'input_kwargs_dict', 'prefix')
     output_index: Index
     fn: Union[str, Callable]
     fn_type: FnType
@@ -109,13 +135,11 @@ class CodegenModule(Module):
     def gc_state(self, state, current_schedule):
         # set of values needed by future instructions
         index_set_needed = set(flatten(self.output_index_list))
-        for inst in current_schedule:
-            args_index_list = flatten(inst.input_args_list)
-            kwargs_index_list = flatten(list(inst.input_kwargs_dict.values()))
-            args_index_list = [i for i in args_index_list if isinstance(i, Index)]
-            kwargs_index_list = [i for i in kwargs_index_list if isinstance(i, Index)]
-            index_set_needed.update(args_index_list)
-            index_set_needed.update(kwargs_index_list)
+        # stream inputs through generators rather than materializing lists per instruction
+        input_iter = chain.from_iterable(
+            chain(inst.input_args_list, inst.input_kwargs_dict.values())
+            for inst in current_schedule)
+        index_set_needed.update(i for i in _inner_flatten(input_iter) if isinstance(i, Index))
         for index in list(state.keys()):
             if index not in index_set_needed:
                 del state[index]
@@ -163,6 +187,77 @@ class CodegenModule(Module):
         else:
             return tuple(sorted_output)
 
+    def fx_arg_from_node_dict(self, graph, node_dict, const_dict, v):
+        if isinstance(v, list):
+            return [self.fx_arg_from_node_dict(graph, node_dict, const_dict, vv) for vv in v]
+        elif isinstance(v, tuple):
+            return tuple(self.fx_arg_from_node_dict(graph, node_dict, const_dict, vv) for vv in v)
+        elif isinstance(v, dict):
+            return {
+                k: self.fx_arg_from_node_dict(graph, node_dict, const_dict, vv)
+                for k, vv in v.items()}
+        elif isinstance(v, Index):
+            return node_dict[v]
+        elif isinstance(v, Tensor):
+            # tensors can't be emitted as literals, they are registered on the root and fetched
+            # keyed by id since tensors compare elementwise
+            if id(v) not in const_dict:
+                node = graph.get_attr(f'_tensor_constant{len(const_dict)}')
+                const_dict[id(v)] = (v, node)
+            return const_dict[id(v)][1]
+        else:
+            return v
+
+    def update_node_dict_from_output(self, graph, node_dict, index, node):
+        if not isinstance(index, list):  # lists can't be used as keys
+            node_dict[index] = node
+        # bind each element of a (possibly nested) output to its own node
+        if isinstance(index, (list, tuple)):
+            for i, ii in enumerate(index):
+                item_node = graph.call_function(operator.getitem, (node, i))
+                self.update_node_dict_from_output(graph, node_dict, ii, item_node)
+
+    def to_fx(self):
+        """
+        Lower the schedule to a torch.fx.GraphModule, so that it can be run without dispatching
+        each instruction from Python at every forward, and passed on to torch.fx based compilers.
+        The GraphModule shares submodules and tensor constants (e.g. parameters consumed directly
+        by a fn) with this CodegenModule.
+        """
+        if fx is None:
+            raise RuntimeError("Lowering to torch.fx requires torch 1.8 or later.")
+        graph = fx.Graph()
+        module_name_dict = {id(m): name for name, m in self.named_modules()}
+        # tensor constants by id -> (tensor, get_attr node)
+        const_dict = {}
+        # attributes the graph refers to by name, i.e. called modules and tensor constants
+        attr_dict = {}
+        node_dict = {index: graph.placeholder(str(index)) for index in self.input_index_list}
+        for inst in self.schedule:
+            args = tuple(
+                self.fx_arg_from_node_dict(graph, node_dict, const_dict, inst.input_args_list))
+            kwargs = self.fx_arg_from_node_dict(
+                graph, node_dict, const_dict, inst.input_kwargs_dict)
+            if inst.fn_type == FnType.METHOD:
+                obj = kwargs.pop('self')
+                node = graph.call_method(inst.fn, (obj,) + args, kwargs)
+            elif inst.fn_type == FnType.ATTRIBUTE:
+                obj = kwargs.pop('self')
+                node = graph.call_function(getattr, (obj, inst.fn))
+            elif isinstance(inst.fn, Module):
+                module_name = module_name_dict[id(inst.fn)]
+                attr_dict[module_name] = inst.fn
+                node = graph.call_module(module_name, args, kwargs)
+            else:
+                node = graph.call_function(inst.fn, args, kwargs)
+            self.update_node_dict_from_output(graph, node_dict, inst.output_index, node)
+        output = [
+            self.fx_arg_from_node_dict(graph, node_dict, const_dict, i)
+            for i in self.output_index_list]
+        graph.output(output[0] if len(output) == 1 else tuple(output))
+        attr_dict.update({node.target: v for v, node in const_dict.values()})
+        return fx.GraphModule(attr_dict, graph)
+
     def forward(self, *args):  # TODO deal with input kwargs
         state: Dict[Index, Any] = {}
         assert len(args) == len(self.input_index_list), "Unexpected number of inputs"
@@ -122,7 +122,7 @@ class MergeBatchNorm2d(Rewriter):
                     bn_input_index = inst.input_args_list[0]
                 except:
                     bn_input_index = list(inst.input_kwargs_dict.values())[0]
-                inst.merge_into_predecessor = None
+                merge_into_predecessor = None
                 inst.fn.merged_inst = []
                 # check that the predecessor doesn't feed into other layers
                 can_merge = True
@@ -136,17 +136,15 @@ class MergeBatchNorm2d(Rewriter):
                     if predecessor.output_index == bn_input_index:
                         if any([isinstance(predecessor.fn, l) for l in self.merge_layers]):
                             merge_bn(predecessor.fn, inst.fn)
-                            inst.merge_into_predecessor = predecessor
+                            merge_into_predecessor = predecessor
                             inst.fn.merged_inst.append(True)
                         else:
                             inst.fn.merged_inst.append(False)
                 # update output index of the predecessor and mark inst as to remove
-                if inst.merge_into_predecessor is not None:
-                    predecessor = inst.merge_into_predecessor
+                if merge_into_predecessor is not None:
+                    predecessor = merge_into_predecessor
                     predecessor.output_index = inst.output_index
                     inst.output_index = None
-                else:
-                    del inst.merge_into_predecessor
         # update schedule to remove merged inst
         model.schedule = [i for i in model.schedule if i.output_index is not None]
         # update module hierarchy to remove merged bn
@@ -8,6 +8,10 @@ from ..module import Index, FnType
 
 @dataclass
 class TraceElem:
+    __slots__ = (
+        'fn', 'fn_type', 'fn_args', 'fn_kwargs', 'fn_out', 'fn_args_index', 'fn_kwargs_index',
+        'fn_out_index', 'module_context_list', 'prefix_list', 'module_input_list',
+        'module_input_index_list', 'module_output', 'module_output_index')
     fn: Callable
     fn_type: FnType
     fn_args: List[Any]
@@ -19,7 +23,10 @@ class TraceElem:
     module_context_list: List[Module]
     prefix_list: List[str]
     module_input_list: List[Any]
-    module_output: Any = None  # set after init
+    module_input_index_list: List[Union[Index, List[Index], Tuple[Index, ...]]]
+    # slots can't have a class level default, so these are passed as None and set after init
+    module_output: Any
+    module_output_index: Union[Index, List[Index], Tuple[Index, ...]]
 
     @property
     def fn_name(self):
@@ -40,9 +47,16 @@ class Trace:
     model_input_list: List[Any] = field(default_factory=list)
     model_output_list: List[Any] = field(default_factory=list)
     trace_elem_list: List[TraceElem] = field(default_factory=list)
+    # only to be extended through index_from_val, which keeps _val_id_index_map in sync
     index_map: Dict[Index, Any] = field(default_factory=dict)
+    # reverse of index_map, keyed by id since values are matched by identity
+    _val_id_index_map: Dict[int, Index] = field(
+        default_factory=dict, init=False, repr=False, compare=False)
     _index_id = -1
 
+    def __post_init__(self):
+        self._val_id_index_map = {id(v): i for i, v in self.index_map.items()}
+
     @property
     def model_input_index_list(self):
         return self.index_from_val(self.model_input_list)
@@ -52,10 +66,9 @@ class Trace:
         return self.index_from_val(self.model_output_list)
 
     def index_from_map(self, val):
-        for i, v in self.index_map.items():
-            if v is val:  # Note "is" and not "=="
-                return i
-        return None
+        # Note lookup by id, i.e. "is" and not "=="
+        # values are kept alive by index_map, so their id can't be recycled
+        return self._val_id_index_map.get(id(val))
 
     def fresh_index_id(self):
         self._index_id += 1
@@ -71,9 +84,11 @@ class Trace:
             return {k: self.index_from_val(v, True) for k, v in value.items()}
         else:
             if index is None:
-                id = self.fresh_index_id()
-                self.index_map[Index(id)] = value
-                return Index(id)
+                # the same Index instance is stored and returned
+                index = Index(self.fresh_index_id())
+                self.index_map[index] = value
+                self._val_id_index_map[id(value)] = index
+                return index
             else:
                 return index
 
@@ -207,6 +207,7 @@ class Tracer(metaclass=TracerMeta):
                     if trace_elem.module_output is None:
                         output = self.repack_value(output)
                         trace_elem.module_output = output
+                        trace_elem.module_output_index = self.trace_.index_from_val(output)
             self.namespace_.pop()
 
         # Identity output of the whole model
@@ -256,6 +257,7 @@ class Tracer(metaclass=TracerMeta):
         fn_args_index = [self.trace_.index_from_val(a) for a in fn_args]
         fn_kwargs_index = {k: self.trace_.index_from_val(a) for k,a in fn_kwargs.items()}
         fn_out_index = self.trace_.index_from_val(fn_out, False)
+        m_input_index_list = [self.trace_.index_from_val(i) for i in m_input_list]
         # generate trace element
         trace_elem = TraceElem(
             fn=fn,
@@ -268,7 +270,10 @@ class Tracer(metaclass=TracerMeta):
             fn_out_index=fn_out_index,
             module_context_list=modules,
             prefix_list=m_names,
-            module_input_list=m_input_list)
+            module_input_list=m_input_list,
+            module_input_index_list=m_input_index_list,
+            module_output=None,
+            module_output_index=None)
         # update trace
         self.trace_.trace_elem_list.append(trace_elem)
         # return fn_out with newly interned values
@@ -1,15 +1,23 @@
+from functools import lru_cache
+
 import torch
 
 
-def module_class_name(m: torch.nn.Module):
-    module = m.__class__.__module__
+@lru_cache(maxsize=None)
+def _class_name(cls: type):
+    module = cls.__module__
     if module is None or module == str.__class__.__module__:
-        full_name = m.__class__.__name__
+        full_name = cls.__name__
     else:
-        full_name = module + '.' + m.__class__.__name__
+        full_name = module + '.' + cls.__name__
     return full_name
 
 
+def module_class_name(m: torch.nn.Module):
+    # the name depends only on the class, so it's computed once per class
+    return _class_name(m.__class__)
+
+
 def _inner_flatten(container):
     for i in container:
         if isinstance(i, (list, tuple)):
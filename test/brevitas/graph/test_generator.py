@@ -1,10 +1,13 @@
 import pytest
 from packaging import version
 import torch
+from torch import nn
 from torchvision import models
 
 from brevitas.graph.tracer import Tracer
 from brevitas.graph.generator import ModuleGenerator
+from brevitas.graph.module import FnType
+from brevitas.graph.rewriter import ModuleToModuleRewriter
 from brevitas_examples.bnn_pynq import lfc_1w1a
 
 SEED = 123456
@@ -13,6 +16,7 @@ INCEPTION_SIZE = (2, 3, 299, 299)
 LARGER_IMAGE_SIZE = (2, 3, 340, 340)
 MNIST_SIZE = (1, 1, 28, 28)
 IS_ABOVE_110 = version.parse(torch.__version__) > version.parse("1.1.0")
+IS_ABOVE_180 = version.parse(torch.__version__) >= version.parse("1.8.0")
 
 MODEL_NAMES = [
     'shufflenet_v2_x0_5',
@@ -63,6 +67,109 @@ def test_generator_torchvision(model_name: str, train: bool, pretrained: bool):
             assert q_out.isclose(out).all().item()
 
 
+class ConvLinearModel(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, kernel_size=3)
+        self.relu = nn.ReLU()
+        self.linear = nn.Linear(4 * 6 * 6, 10)
+
+    def forward(self, x):
+        x = self.relu(self.conv(x))
+        x = torch.flatten(x, 1)
+        return self.linear(x)
+
+
+def test_generator_empty_allowlist():
+    model = ConvLinearModel().train(False)
+    torch.manual_seed(SEED)
+    input = torch.randn(1, 3, 8, 8)
+    with torch.no_grad():
+        trace = Tracer(input).trace_model(model)
+        generator = ModuleGenerator(gen_module_allowlist=())
+        assert not generator._any_module_in_gen_allowlist(trace)
+        gen_model = generator.gen_model(trace)
+        # nothing is preserved as-is, every module is unrolled into the fns it calls
+        for inst in gen_model.schedule:
+            assert inst.fn_type is not FnType.MODULE
+            assert not isinstance(inst.fn, nn.Module)
+        torch.manual_seed(SEED + 1)
+        inp2 = torch.randn(1, 3, 8, 8)
+        assert gen_model(inp2).isclose(model(inp2)).all().item()
+
+
+@pytest.mark.parametrize("gen_cache_size", [0, 1])
+def test_generator_regen_after_rewrite(gen_cache_size: int):
+    model = ConvLinearModel().train(False)
+    torch.manual_seed(SEED)
+    input = torch.randn(1, 3, 8, 8)
+    with torch.no_grad():
+        trace = Tracer(input).trace_model(model)
+        generator = ModuleGenerator(gen_cache_size=gen_cache_size)
+        gen_model = generator.gen_model(trace)
+        fn_list = [inst.fn for inst in gen_model.schedule]
+        # rewrite the first generated model in place
+        gen_model = ModuleToModuleRewriter(nn.Conv2d, nn.Conv2d).apply(gen_model)
+        assert not any(inst.fn is model.conv for inst in gen_model.schedule)
+        regen_model = generator.gen_model(trace)
+        assert len(generator._gen_cache) == gen_cache_size
+        # the regenerated model is unaffected by the rewrite
+        assert [inst.fn for inst in regen_model.schedule] == fn_list
+        assert any(inst.fn is model.conv for inst in regen_model.schedule)
+        assert regen_model.conv is model.conv
+        generator.clear_cache()
+        assert not generator._gen_cache
+        cleared_model = generator.gen_model(trace)
+        assert [inst.fn for inst in cleared_model.schedule] == fn_list
+        torch.manual_seed(SEED + 1)
+        inp2 = torch.randn(1, 3, 8, 8)
+        out = model(inp2)
+        assert regen_model(inp2).isclose(out).all().item()
+        assert cleared_model(inp2).isclose(out).all().item()
+
+
+@pytest.mark.skipif(not IS_ABOVE_180, reason="torch.fx requires torch 1.8 or later.")
+@pytest.mark.parametrize("model_name", ['resnet18', 'mobilenet_v2'])
+def test_generator_to_fx_torchvision(model_name: str):
+    model = getattr(models, model_name)(pretrained=False)
+    model = model.train(False)
+    torch.manual_seed(SEED)
+    input = torch.randn(IMAGENET_SIZE)
+    with torch.no_grad():
+        trace = Tracer(input).trace_model(model)
+        gen_model = ModuleGenerator().gen_model(trace)
+        gen_model.load_state_dict(model.state_dict())
+        gen_model.train(False)
+        fx_model = gen_model.to_fx()
+        torch.manual_seed(SEED + 1)
+        inp2 = torch.randn(IMAGENET_SIZE)
+        out = gen_model(inp2)
+        fx_out = fx_model(inp2)
+        assert fx_out.isclose(out).all().item()
+
+
+
+@pytest.mark.skipif(not IS_ABOVE_180, reason="torch.fx requires torch 1.8 or later.")
+def test_generator_to_fx_empty_allowlist():
+    model = ConvLinearModel().train(False)
+    torch.manual_seed(SEED)
+    input = torch.randn(1, 3, 8, 8)
+    with torch.no_grad():
+        trace = Tracer(input).trace_model(model)
+        gen_model = ModuleGenerator(gen_module_allowlist=()).gen_model(trace)
+        fx_model = gen_model.to_fx()
+        # parameters consumed by fns are fetched from the root rather than inlined as literals
+        get_attr_targets = [n.target for n in fx_model.graph.nodes if n.op == 'get_attr']
+        assert get_attr_targets
+        for target in get_attr_targets:
+            assert any(getattr(fx_model, target) is p for p in model.parameters())
+        fx_model.recompile()
+        torch.manual_seed(SEED + 1)
+        inp2 = torch.randn(1, 3, 8, 8)
+        assert fx_model(inp2).isclose(model(inp2)).all().item()
+
+
 # TODO fix tracing and generating a graph containing ScriptModules
 @pytest.mark.skip(reason="This is still broken")
 def test_generator_bnn_pynq(train=False):